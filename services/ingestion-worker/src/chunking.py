@@ -1,14 +1,157 @@
-import hashlib
+import copy
 import logging
+import re
 from typing import List, Dict
-from langchain_text_splitters import MarkdownHeaderTextSplitter
-from langchain_experimental.text_splitter import SemanticChunker
+import numpy as np
+from blake3 import blake3
+from langchain_experimental.text_splitter import SemanticChunker, combine_sentences
 from langchain_core.documents import Document
+from embedding_cache import content_hash
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Markdown header levels the chunker splits on -> metadata key
+HEADER_NAMES = {1: "Header 1", 2: "Header 2", 3: "Header 3"}
+# Pages of a batch are joined with this line so one regex pass covers the whole batch
+PAGE_SEPARATOR = "\n\x1e\n"
+# One scan finds every page separator, code fence and header line (#, ##, ###).
+# A fence only has to start the line, so "```python" opens a block like "```" does.
+# Like MarkdownHeaderTextSplitter, a header needs a space (not a tab) after its #s.
+HEADER_PATTERN = re.compile(
+    r"^(?:(?P<page>\x1e)"
+    r"|[ \t]*(?P<fence>```|~~~)(?P<info>.*)"
+    r"|[ \t]*(?P<level>#{1,3})(?= |$)[ \t]*(?P<title>.*?)[ \t]*)$",
+    re.MULTILINE
+)
+
+
+class BatchedSemanticChunker(SemanticChunker):
+    """
+    SemanticChunker that embeds the sentences of a whole batch of documents at once.
+    The stock splitter calls embed_documents() once per document, so a 10 page batch
+    pays for dozens of tiny forward passes. Here every sentence window of every
+    document goes into a single embed_documents() call and the breakpoint logic
+    runs per document on its slice of the results.
+    """
+
+    def split_document_batch(self, documents: List[Document]) -> List[List[Document]]:
+        """
+        Splits every document, embedding all of their sentences in one call.
+        Returns one list of chunks per input document (same order).
+        """
+        # Pass 1: Sentence-split every document and collect the texts to embed.
+        # offsets[i] is where document i's sentences start in all_sentences
+        # (None means the document is too short to split semantically).
+        page_sentences = []
+        offsets = []
+        all_sentences = []
+
+        for doc in documents:
+            single_sentences_list = self._get_single_sentences_list(doc.page_content)
+
+            # Nothing to split semantically: with one or two sentences there is at most one
+            # distance, and it never exceeds a threshold computed from itself. Skip embedding.
+            # (gradient keeps SemanticChunker's behaviour of one chunk per sentence)
+            if len(single_sentences_list) <= 2:
+                if self.breakpoint_threshold_type == "gradient":
+                    page_sentences.append(single_sentences_list)
+                else:
+                    page_sentences.append([" ".join(single_sentences_list)])
+                offsets.append(None)
+                continue
+
+            sentences = combine_sentences(
+                [{"sentence": x, "index": i} for i, x in enumerate(single_sentences_list)],
+                self.buffer_size
+            )
+            page_sentences.append(sentences)
+            offsets.append(len(all_sentences))
+            all_sentences.extend(x["combined_sentence"] for x in sentences)
+
+        # Pass 2: One embedding call for the whole batch, stacked into one contiguous matrix
+        embedding_matrix = self._embed_normalized(all_sentences)
+
+        # Pass 3: Breakpoints per document, using its slice of the embeddings
+        results = []
+        for doc, sentences, offset in zip(documents, page_sentences, offsets):
+            if offset is None:
+                chunks = sentences
+            else:
+                distances = self._adjacent_cosine_distances(
+                    embedding_matrix[offset:offset + len(sentences)]
+                )
+                chunks = self._group_sentences(sentences, distances)
+
+            results.append([
+                Document(page_content=chunk, metadata=copy.deepcopy(doc.metadata))
+                for chunk in chunks
+            ])
+
+        return results
+
+
+    def _embed_normalized(self, sentences: List[str]) -> np.ndarray:
+        """
+        Embeds the sentences and returns them as an L2-normalized FP16 matrix.
+        Normalizing once here makes cosine similarity a plain dot product later,
+        and FP16 halves the bytes the distance pass has to stream through.
+        """
+        if not sentences:
+            return np.empty((0, 0), dtype=np.float16)
+
+        matrix = np.asarray(self.embeddings.embed_documents(sentences), dtype=np.float32)
+        matrix /= np.clip(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12, None)
+        return matrix.astype(np.float16)
+
+
+    @staticmethod
+    def _adjacent_cosine_distances(embeddings: np.ndarray) -> np.ndarray:
+        """
+        Cosine distance between each sentence window and the next one.
+        Rows are unit-length, so cosine similarity is a plain row-wise dot product:
+        one vectorized pass instead of a cosine_similarity() call per pair.
+        Only this document's rows are promoted to FP32 for the accumulation.
+        """
+        rows = embeddings.astype(np.float32)
+        similarities = np.einsum("ij,ij->i", rows[:-1], rows[1:])
+        return 1.0 - similarities
+
+
+    def _group_sentences(self, sentences: List[Dict], distances: np.ndarray) -> List[str]:
+        """
+        Cuts the sentence list wherever the distance crosses the breakpoint threshold.
+        Mirrors the grouping loop of SemanticChunker.split_text.
+        """
+        if self.number_of_chunks is not None:
+            breakpoint_distance_threshold = self._threshold_from_clusters(distances)
+            breakpoint_array = distances
+        else:
+            breakpoint_distance_threshold, breakpoint_array = self._calculate_breakpoint_threshold(distances)
+
+        indices_above_thresh = [
+            i for i, x in enumerate(breakpoint_array) if x > breakpoint_distance_threshold
+        ]
+
+        chunks = []
+        start_index = 0
+        for index in indices_above_thresh:
+            group = sentences[start_index:index + 1]
+            combined_text = " ".join(d["sentence"] for d in group)
+            # If specified, merge together small chunks.
+            if self.min_chunk_size is not None and len(combined_text) < self.min_chunk_size:
+                continue
+            chunks.append(combined_text)
+            start_index = index + 1
+
+        # The last group, if any sentences remain
+        if start_index < len(sentences):
+            chunks.append(" ".join(d["sentence"] for d in sentences[start_index:]))
+
+        return chunks
+
+
 class DocumentChunker:
     """
     Intelligently splits Markdown text into semantic chunks for RAG.
@@ -20,31 +163,27 @@ class DocumentChunker:
        - Splits only when the 'topic' changes (similarity drops below threshold).
     """
 
-    def __init__(self, embedding_model):
+    def __init__(self, embedding_model, min_semantic_chars: int = 1500):
         """
         Args:
             embedding_model: An initialized HuggingFaceEmbeddings object. 
                              Passed from main.py to save RAM.
+            min_semantic_chars: Pages shorter than this keep their header splits as-is
+                                (title pages, near-empty pages): embedding them gains nothing.
         """
         # We store the shared model instance. 
         # No heavy loading happens here anymore!
         self.embedding_model = embedding_model
+        self.min_semantic_chars = min_semantic_chars
         
         # Stage 1: Structural Splitter (Respects Headers)
-        # This one is purely rule-based (regex), so it's lightweight.
-        self.header_splitter = MarkdownHeaderTextSplitter(
-            headers_to_split_on=[
-                ("#", "Header 1"),
-                ("##", "Header 2"),
-                ("###", "Header 3"),
-            ],
-            strip_headers=False 
-        )
+        # This one is purely rule-based (a precompiled regex, see split_headers), so it's lightweight.
 
         # Stage 2: Semantic Splitter (The "Smart" Part)
         # We pass the shared model here. It uses this model to calculate 
         # the "distance" between sentences to decide where to cut.
-        self.semantic_splitter = SemanticChunker(
+        # The batched variant embeds all pages of a batch in a single call.
+        self.semantic_splitter = BatchedSemanticChunker(
             embeddings=self.embedding_model,
             breakpoint_threshold_type="percentile" 
         )
@@ -56,6 +195,7 @@ class DocumentChunker:
         Processes a batch of page results from the VisionPDFParser.
         """
         all_chunks = []
+        pages = []
 
         for page_data in batch_results:
             text = page_data.get("text", "")
@@ -65,31 +205,54 @@ class DocumentChunker:
             page_num = page_data.get("page_num", 0)
             original_metadata = page_data.get("metadata", {})
             source_file = original_metadata.get("source", "unknown_file")
+            pages.append((page_num, original_metadata, source_file, text))
 
-            # STEP A: Logical Split (Headers)
-            try:
-                header_splits = self.header_splitter.split_text(text)
-            except Exception as e:
-                logger.warning(f"Markdown splitting failed on {source_file} p{page_num}. Error: {e}")
-                header_splits = [Document(page_content=text)]
-
-            # STEP B: Semantic Split
-            try:
-                final_splits = self.semantic_splitter.split_documents(header_splits)
-            except Exception as e:
-                logger.warning(f"Semantic splitting failed. Fallback to headers. Error: {e}")
-                final_splits = header_splits
-
-            # STEP C: Format for Database
-            for split in final_splits:
+        # STEP A: Logical Split (Headers), one regex pass over the whole batch
+        texts = [text for *_, text in pages]
+        try:
+            final_splits = self.split_headers(texts)
+        except Exception as e:
+            logger.warning(f"Markdown splitting failed. Fallback to whole pages. Error: {e}")
+            final_splits = [[Document(page_content=text)] for text in texts]
+
+        # STEP B: Semantic Split (all long pages of the batch share one embedding call)
+        # Fast path: short pages keep their header splits, nothing gets embedded for them.
+        long_pages = [
+            i for i, splits in enumerate(final_splits)
+            if sum(len(split.page_content) for split in splits) >= self.min_semantic_chars
+        ]
+
+        header_docs = [doc for i in long_pages for doc in final_splits[i]]
+        try:
+            semantic_splits = self.semantic_splitter.split_document_batch(header_docs)
+        except Exception as e:
+            logger.warning(f"Semantic splitting failed. Fallback to headers. Error: {e}")
+            semantic_splits = [[doc] for doc in header_docs]
+
+        # Map the per-section results back to their pages
+        offset = 0
+        for i in long_pages:
+            section_count = len(final_splits[i])
+            final_splits[i] = [s for splits in semantic_splits[offset:offset + section_count] for s in splits]
+            offset += section_count
+
+        # STEP C: Format for Database
+        semantic_pages = set(long_pages)
+        for i, ((page_num, original_metadata, source_file, _), page_splits) in enumerate(zip(pages, final_splits)):
+            # Fast-path pages were only split at their headers
+            chunk_strategy = "semantic" if i in semantic_pages else "header"
+            for split in page_splits:
+                # BLAKE3 digest of the full chunk text (same helper as the embedding cache)
+                chunk_hash = content_hash(split.page_content)
                 combined_metadata = {
                     **original_metadata,
                     **split.metadata,
                     "page_num": page_num,
-                    "chunk_strategy": "semantic"
+                    "chunk_strategy": chunk_strategy,
+                    "content_hash": chunk_hash
                 }
 
-                chunk_id = self._generate_chunk_id(source_file, page_num, split.page_content)
+                chunk_id = self._generate_chunk_id(source_file, page_num, chunk_hash)
 
                 all_chunks.append({
                     "id": chunk_id,
@@ -101,9 +264,79 @@ class DocumentChunker:
         return all_chunks
 
 
-    def _generate_chunk_id(self, source: str, page: int, chunk_text: str) -> str:
+    def split_headers(self, texts: List[str]) -> List[List[Document]]:
+        """
+        Splits each page at its Markdown headers (#, ##, ###), keeping the header line
+        in its section and the header path in metadata ("Header 1", "Header 2", ...).
+        All pages are joined with PAGE_SEPARATOR and scanned by HEADER_PATTERN once,
+        instead of running a line-by-line splitter per page. Headers inside code
+        fences are ignored. As in MarkdownHeaderTextSplitter(strip_headers=False), sections
+        with the same header path are merged, and a section holding only headers is folded
+        into the deeper section after it.
+        Returns one list of sections per page.
+        """
+        combined = PAGE_SEPARATOR.join(text.replace("\x1e", "") for text in texts)
+        results = [[] for _ in texts]
+
+        page = 0
+        headers = {}          # Current header path of the page: level -> title
+        section_start = 0
+        open_fence = None     # The fence that opened the current code block, if any
+
+        def close_section(end: int):
+            content = combined[section_start:end].strip()
+            if not content:
+                return
+            metadata = {HEADER_NAMES[level]: title for level, title in headers.items()}
+            sections = results[page]
+            if not sections:
+                sections.append(Document(page_content=content, metadata=metadata))
+            # Same header path as the previous section (e.g. a repeated "# Notes"): one section
+            elif sections[-1].metadata == metadata:
+                sections[-1].page_content += "\n" + content
+            # "# Title" directly followed by "## Section": the header joins the section below
+            elif (
+                sections[-1].page_content.rsplit("\n", 1)[-1].lstrip().startswith("#")
+                and len(sections[-1].metadata) < len(metadata)
+            ):
+                sections[-1].page_content += "\n" + content
+                sections[-1].metadata = metadata
+            else:
+                sections.append(Document(page_content=content, metadata=metadata))
+
+        for match in HEADER_PATTERN.finditer(combined):
+            if match.group("page"):
+                close_section(match.start())
+                page += 1
+                headers = {}
+                section_start = match.end()
+                open_fence = None
+            elif match.group("fence"):
+                fence = match.group("fence")
+                if open_fence is None:
+                    # ```code``` on a single line is an inline span, not a fence
+                    if fence == "~~~" or "```" not in match.group("info"):
+                        open_fence = fence
+                elif fence == open_fence:
+                    open_fence = None
+            elif open_fence is None:
+                close_section(match.start())
+                level = len(match.group("level"))
+                # A header closes every open header of the same or a deeper level
+                headers = {l: t for l, t in headers.items() if l < level}
+                headers[level] = match.group("title")
+                section_start = match.start()
+
+        close_section(len(combined))
+        return results
+
+
+    def _generate_chunk_id(self, source: str, page: int, chunk_hash: str) -> str:
         """
         Creates a unique ID based on File Source + Page + Content.
+        Uses the digest of the whole chunk (not a text prefix), so chunks that start
+        with the same header no longer collide, and the chunk text is not hashed twice.
+        16-byte BLAKE3 digest: same 32-hex-char shape as the old MD5 ids.
         """
-        raw_id = f"{source}-p{page}-{chunk_text[:50]}"
-        return hashlib.md5(raw_id.encode('utf-8')).hexdigest()
\ No newline at end of file
+        raw_id = f"{source}-p{page}-{chunk_hash}".encode("utf-8")
+        return blake3(raw_id).hexdigest(length=16)
\ No newline at end of file
@@ -0,0 +1,140 @@
+import logging
+from collections import OrderedDict
+from typing import List, Optional
+import numpy as np
+from blake3 import blake3
+from diskcache import Cache
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(text: str) -> str:
+    """
+    BLAKE3 hex digest of a text. Used as the cache key for its embedding.
+    """
+    return blake3(text.encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Two-tier cache in front of the shared embedding model.
+    Design: Documents repeat a lot of text (headers, footers, legal boilerplate, forms),
+    so every sentence is looked up by content hash before it reaches the model.
+    1. In-process LRU dict (fast, bounded by max_memory_items).
+    2. Persistent diskcache store (survives worker restarts, shared across jobs).
+    Only the misses are sent to the model, in a single embed_documents() call.
+    """
+
+    def __init__(
+            self,
+            embedding_model: Embeddings,
+            cache_dir: Optional[str] = None,
+            namespace: str = "default",
+            max_memory_items: int = 50_000
+        ):
+        """
+        Args:
+            embedding_model: The shared embedding model (e.g. HuggingFaceEmbeddings).
+            cache_dir: Directory for the persistent tier. None keeps the cache in memory only.
+            namespace: Prefix for persistent keys. Use the model name so vectors from
+                       different models never mix.
+            max_memory_items: Number of vectors kept in the in-process LRU.
+        """
+        self.embedding_model = embedding_model
+        self.namespace = namespace
+        self.max_memory_items = max_memory_items
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._disk = None
+
+        if cache_dir:
+            try:
+                self._disk = Cache(cache_dir)
+                logger.info(f"Embedding cache persisted at {cache_dir}")
+            except Exception as e:
+                # The persistent tier is an optimization, never a reason to fail
+                logger.warning(f"Could not open embedding cache at {cache_dir}. Using memory only. Error: {e}")
+
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Returns one vector per text, embedding only the texts not seen before.
+        """
+        hashes = [content_hash(text) for text in texts]
+        vectors = {}
+        missing = {}
+
+        # Tier 1 + 2 lookups (duplicates inside the batch are embedded once)
+        for text, key in zip(texts, hashes):
+            if key in vectors or key in missing:
+                continue
+            vector = self._lookup(key)
+            if vector is None:
+                missing[key] = text
+            else:
+                vectors[key] = vector
+
+        # Embed all misses in one batch and write them back
+        if missing:
+            new_vectors = self.embedding_model.embed_documents(list(missing.values()))
+            for key, vector in zip(missing, new_vectors):
+                vectors[key] = np.asarray(vector, dtype=np.float32)
+            self._store({key: vectors[key] for key in missing})
+
+        logger.debug(f"Embedding cache: {len(texts) - len(missing)}/{len(texts)} hits.")
+        return [vectors[key].tolist() for key in hashes]
+
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embedding_model.embed_query(text)
+
+
+    def _lookup(self, key: str) -> Optional[np.ndarray]:
+        """
+        Checks the in-process LRU first, then the persistent store.
+        """
+        vector = self._memory.get(key)
+        if vector is not None:
+            self._memory.move_to_end(key)
+            return vector
+
+        if self._disk is None:
+            return None
+
+        try:
+            raw = self._disk.get(f"{self.namespace}:{key}")
+        except Exception as e:
+            # A locked or corrupt store only costs a recompute
+            logger.warning(f"Failed to read cached embedding. Treating it as a miss. Error: {e}")
+            return None
+        if raw is None:
+            return None
+
+        vector = np.frombuffer(raw, dtype=np.float32)
+        self._remember(key, vector)
+        return vector
+
+
+    def _store(self, new_vectors: dict):
+        """
+        Writes freshly computed vectors to both tiers.
+        """
+        for key, vector in new_vectors.items():
+            self._remember(key, vector)
+
+        if self._disk is None:
+            return
+
+        try:
+            with self._disk.transact():
+                for key, vector in new_vectors.items():
+                    self._disk.set(f"{self.namespace}:{key}", vector.tobytes())
+        except Exception as e:
+            logger.warning(f"Failed to persist embeddings. Error: {e}")
+
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
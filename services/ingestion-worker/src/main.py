@@ -1,8 +1,12 @@
 import logging
 import os
 import sys
-import json
+import orjson
+import queue
+import tempfile
+import threading
 import pika
+import torch
 from minio import Minio
 from langchain_huggingface import HuggingFaceEmbeddings
 from dotenv import load_dotenv
@@ -13,6 +17,7 @@ load_dotenv()
 # --- CORRECT IMPORTS (Same Directory) ---
 from pdf_parser import VisionPDFParser
 from chunking import DocumentChunker
+from embedding_cache import CachedEmbeddings
 # ----------------------------------------
 
 # --- CONFIGURATION ---
@@ -21,12 +26,21 @@ MINIO_ENDPOINT = os.getenv("MINIO_ENDPOINT")
 MINIO_ACCESS_KEY = os.getenv("MINIO_ACCESS_KEY")
 MINIO_SECRET_KEY = os.getenv("MINIO_SECRET_KEY")
 MINIO_BUCKET_NAME = os.getenv("MINIO_BUCKET_NAME")
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "/tmp/embedding-cache")
+VISION_NUM_CONTEXTS = int(os.getenv("VISION_NUM_CONTEXTS", "1"))
+# "torch" (original FP32 sentence-transformers) or "onnx-int8" (quantized, faster on CPU).
+# int8 is opt-in: its vectors shift the semantic breakpoints slightly compared to FP32.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "/tmp/onnx-models")
 
 # Constants
 RABBITMQ_QUEUE = "ingestion_queue"
 VISION_MODEL_PATH = "models/Qwen2-VL-2B-Instruct-Q4_K_M.gguf"
 VISION_MMPROJ_PATH = "models/mmproj-Qwen2-VL-2B-Instruct-f16.gguf"
 EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+BATCH_QUEUE_SIZE = 2  # Parsed batches waiting for the chunker (bounds peak memory)
+# Half the cores for embedding; the vision model's llama.cpp threads use the other half
+EMBEDDING_THREADS = max(1, (os.cpu_count() or 2) // 2)
 
 # Configure Logging
 logging.basicConfig(
@@ -61,13 +75,33 @@ def init_services():
         sys.exit(1)
 
     # 2. Shared Embedding Model (RAM Optimization)
-    logger.info(f"Loading Embedding Model: {EMBEDDING_MODEL_NAME}")
+    logger.info(f"Loading Embedding Model: {EMBEDDING_MODEL_NAME} ({EMBEDDING_BACKEND})")
     try:
-        shared_model = HuggingFaceEmbeddings(
-            model_name=EMBEDDING_MODEL_NAME,
-            model_kwargs={'device': 'cpu'}, 
-            encode_kwargs={'normalize_embeddings': True}
-        )
+        # Pin threads before any model runs: by default PyTorch grabs every core,
+        # which oversubscribes the CPU alongside llama.cpp.
+        torch.set_num_threads(EMBEDDING_THREADS)
+        torch.set_num_interop_threads(1)
+
+        if EMBEDDING_BACKEND == "onnx-int8":
+            # Imported here so the default torch path never loads optimum / onnxruntime
+            from quantized_embeddings import QuantizedEmbeddings
+            shared_model = QuantizedEmbeddings(
+                model_name=EMBEDDING_MODEL_NAME,
+                cache_dir=ONNX_MODEL_DIR,
+                batch_size=64,
+                num_threads=EMBEDDING_THREADS
+            )
+        else:
+            shared_model = HuggingFaceEmbeddings(
+                model_name=EMBEDDING_MODEL_NAME,
+                model_kwargs={'device': 'cpu'}, 
+                encode_kwargs={
+                    'batch_size': 64,
+                    'normalize_embeddings': True,
+                    'convert_to_numpy': True,
+                    'show_progress_bar': False
+                }
+            )
     except Exception as e:
         logger.critical(f"Failed to load embedding model: {e}")
         sys.exit(1)
@@ -78,10 +112,16 @@ def init_services():
         pdf_parser = VisionPDFParser(
             model_path=VISION_MODEL_PATH,
             mmproj_path=VISION_MMPROJ_PATH,
+            num_contexts=VISION_NUM_CONTEXTS,
         )
         
-        # Initialize Chunker
-        chunker = DocumentChunker(embedding_model=shared_model)
+        # Initialize Chunker (sentence embeddings are cached by content hash)
+        cached_model = CachedEmbeddings(
+            shared_model,
+            cache_dir=EMBEDDING_CACHE_DIR,
+            namespace=f"{EMBEDDING_MODEL_NAME}-{EMBEDDING_BACKEND}"
+        )
+        chunker = DocumentChunker(embedding_model=cached_model)
         logger.info("✔ AI Models Initialized.")
         
     except Exception as e:
@@ -90,22 +130,65 @@ def init_services():
 
 
 def download_file_from_minio(bucket_name, object_name):
-    """Downloads file bytes from MinIO into memory."""
+    """
+    Streams the file from MinIO into a temp file and returns its path.
+    The PDF never sits in RAM as a whole; the caller deletes the file when done.
+    """
+    pdf_file = tempfile.NamedTemporaryFile(prefix="docstream-", suffix=".pdf", delete=False)
     try:
         response = minio_client.get_object(bucket_name, object_name)
-        file_data = response.read()
-        response.close()
-        response.release_conn()
-        return file_data
+        try:
+            with pdf_file:
+                for chunk in response.stream(32 * 1024):
+                    pdf_file.write(chunk)
+        finally:
+            response.close()
+            response.release_conn()
+        return pdf_file.name
     except Exception as e:
         logger.error(f"MinIO Download Error: {e}")
+        pdf_file.close()
+        os.remove(pdf_file.name)
         return None
 
 
+def produce_batches(pdf_path, filename, batch_queue, stop_event):
+    """
+    Parser thread: runs the vision model over the PDF and hands each batch to the chunker.
+    The stream ends with None, or with the exception that stopped it.
+    """
+    def put(item):
+        # Blocks while the queue is full, but gives up once the consumer has stopped
+        while not stop_event.is_set():
+            try:
+                batch_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    # Parser yields overlapping batches automatically
+    batches = pdf_parser.parse_pdf_in_batches(pdf_path, source_name=filename)
+    try:
+        # Checked before every batch, so an abandoned job stops using the VLM
+        while not stop_event.is_set():
+            batch = next(batches, None)
+            if batch is None:
+                put(None)
+                return
+            if not put(batch):
+                return
+    except Exception as e:
+        put(e)
+    finally:
+        # Stops the parser's prefetch and removes its temp pages
+        batches.close()
+
+
 def process_job(ch, method, properties, body):
     """Callback function triggered when a RabbitMQ message arrives."""
     try:
-        job_data = json.loads(body)
+        job_data = orjson.loads(body)
         logger.info(f"Received Job: {job_data}")
         
         bucket_name = job_data.get("bucket", MINIO_BUCKET_NAME)
@@ -118,9 +201,9 @@ def process_job(ch, method, properties, body):
 
         # 1. DOWNLOAD
         logger.info(f"Downloading {object_name}...")
-        pdf_bytes = download_file_from_minio(bucket_name, object_name)
+        pdf_path = download_file_from_minio(bucket_name, object_name)
         
-        if not pdf_bytes:
+        if not pdf_path:
             logger.error("Failed to download file. Skipping.")
             ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
             return
@@ -130,24 +213,44 @@ def process_job(ch, method, properties, body):
         total_chunks = 0
         filename = os.path.basename(object_name)
         
-        # Parser yields overlapping batches automatically
-        for batch in pdf_parser.parse_pdf_in_batches(pdf_bytes, source_name=filename):
-            
-            # Semantic Chunking
-            chunks = chunker.chunk_batch(batch)
-            
-            # TODO: vector_store.upsert(chunks)
-            
-            count = len(chunks)
-            total_chunks += count
-            logger.info(f"  -> Batch processed: {count} chunks generated.")
+        # The parser runs in its own thread so the VLM keeps working on the next pages
+        # while this thread chunks + embeds the previous batch.
+        batch_queue = queue.Queue(maxsize=BATCH_QUEUE_SIZE)
+        stop_event = threading.Event()
+        producer = threading.Thread(
+            target=produce_batches,
+            args=(pdf_path, filename, batch_queue, stop_event),
+            daemon=True
+        )
+        producer.start()
+
+        try:
+            while (batch := batch_queue.get()) is not None:
+                if isinstance(batch, Exception):
+                    raise batch
+
+                # Semantic Chunking
+                chunks = chunker.chunk_batch(batch)
+                
+                # TODO: vector_store.upsert(chunks)
+                
+                count = len(chunks)
+                total_chunks += count
+                logger.info(f"  -> Batch processed: {count} chunks generated.")
+        finally:
+            # Lets the parser thread exit if we stopped early, and waits for it:
+            # poppler may still be reading the PDF, and the VLM contexts must be
+            # free before the next job starts.
+            stop_event.set()
+            producer.join()
+            os.remove(pdf_path)
 
         logger.info(f"Job Complete. File: {object_name} | Total Chunks: {total_chunks}")
 
         # 3. ACKNOWLEDGE
         ch.basic_ack(delivery_tag=method.delivery_tag)
 
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         logger.error("Failed to decode JSON body")
         ch.basic_ack(delivery_tag=method.delivery_tag)
     except Exception as e:
@@ -1,56 +1,131 @@
 import io
 import os 
 import logging
-import base64
 import gc 
-from typing import List, Dict, Generator
-from pdf2image import convert_from_bytes, pdfinfo_from_bytes
-from llama_cpp import Llama
+import queue
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Generator, Tuple
+import pybase64
+import xxhash
+from cachetools import LRUCache
+from pdf2image import convert_from_path, pdfinfo_from_path
+from llama_cpp import GGML_TYPE_Q8_0, Llama
 from llama_cpp.llama_chat_format import Llava15ChatHandler
 from PIL import Image
 
 # Sets up logging for better debugging 
 logger = logging.getLogger(__name__)
 
+# Initial size of each pooled page buffer. A 150 DPI A4 JPEG is ~0.5-2MB; buffers grow if needed.
+PAGE_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Number of page results remembered for duplicate pages (blank pages, repeated forms)
+PAGE_CACHE_SIZE = 256
+
+# Vision tokens grow with pixel count, so pages are capped at this many pixels on the longer side.
+MAX_IMAGE_SIDE = 1280
+# The vision encoder is robust to JPEG artifacts; 85 makes the base64 payload much smaller than 95.
+JPEG_QUALITY = 85
+# Bytes of the page JPEG handed to PIL to read its size. The markers before the image data
+# (quantization/Huffman tables, SOF) are a few KB, so the page itself is never copied.
+JPEG_HEADER_BYTES = 64 * 1024
+
 class VisionPDFParser:
     """
     Core Engine for parsing the pdf and extracting text from the pdf using Vision Language Model (Qwen2-VL)
     Design: Processing 10 pages at a time to minimize memory usage and prevent RAM from crashing.
+    Pages of a batch are inferred concurrently on a pool of independent llama.cpp contexts.
     """
-    def __init__(self, model_path: str, mmproj_path: str, use_gpu: bool = True, verbose: bool = False):
+    def __init__(
+            self,
+            model_path: str,
+            mmproj_path: str,
+            use_gpu: bool = True,
+            verbose: bool = False,
+            num_contexts: int = 1
+        ):
         """
         Initialize the Qwen2-VL model.
         Args:
             model_path: Path to the .gguf model file.
             mmproj_path: Path to the .gguf vision projector file.
             use_gpu: If True, offloads layers to GPU.
+            num_contexts: Number of model contexts, i.e. pages inferred in parallel.
+                          Each context loads its own vision projector, KV cache and compute
+                          buffers. With use_gpu every context also uploads its own full copy
+                          of the weights to VRAM, so size VRAM for N copies before raising it.
         """
         if not os.path.exists(model_path) or not os.path.exists(mmproj_path):
             raise ValueError("Model path and projector path are required.")
         
-        logger.info("Loading Vision Model ...")
+        self.num_contexts = max(1, num_contexts)
+        logger.info(f"Loading Vision Model ({self.num_contexts} context(s)) ...")
 
         try:
-            self.chat_handler = Llava15ChatHandler(clip_model_path=mmproj_path)
-            self.llm = Llama(
-                model_path=model_path,
-                chat_handler=self.chat_handler,
-                n_ctx=4096,            # Context window (safe for 1 page)
-                n_gpu_layers=-1 if use_gpu else 0,
-                n_batch=256,           # Batch size for prompt processing
-                verbose=verbose,
-                logits_all=False
-            )
+            # Idle contexts wait in this queue; an inference call borrows one and returns it.
+            self._contexts = queue.Queue()
+            for _ in range(self.num_contexts):
+                self._contexts.put(self._load_model(model_path, mmproj_path, use_gpu, verbose))
             logger.info("Vision Model loaded successfully.")
 
         except Exception as e:
             logger.critical(f"Failed to load model: {e}")
             raise RuntimeError("Model initialization failed") from e
+
+        # llama.cpp releases the GIL while it runs, so plain threads give real parallelism
+        self._inference_pool = ThreadPoolExecutor(
+            max_workers=self.num_contexts,
+            thread_name_prefix="vlm-inference"
+        )
+        # Single-slot prefetcher: rasterizes the next batch while the current one is inferred
+        self._raster_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf-raster")
+
+        # Memory Pool: one reusable read buffer per context, so pages don't allocate
+        # (and free) a fresh multi-MB bytes object each time.
+        self._page_buffers = queue.Queue()
+        for _ in range(self.num_contexts):
+            self._page_buffers.put(bytearray(PAGE_BUFFER_SIZE))
+
+        # Page Cache: xxh3 of the page JPEG -> extracted text. Identical pages render to
+        # identical bytes, so a repeat skips the VLM entirely. Shared by the inference threads.
+        self._page_cache = LRUCache(maxsize=PAGE_CACHE_SIZE)
+        self._page_cache_lock = threading.Lock()
+
+
+    def _load_model(self, model_path: str, mmproj_path: str, use_gpu: bool, verbose: bool) -> Llama:
+        """
+        Loads one independent model context.
+        On CPU the weights are mmap'd, so contexts share them in RAM. With GPU offload each
+        context uploads its own copy of the weights to VRAM.
+        """
+        chat_handler = Llava15ChatHandler(clip_model_path=mmproj_path)
+        # Half the cores for llama.cpp (main.py gives the other half to embedding)
+        threads_per_context = max(1, (os.cpu_count() or 2) // 2 // self.num_contexts)
+        return Llama(
+            model_path=model_path,
+            chat_handler=chat_handler,
+            n_ctx=4096,            # Context window (safe for 1 page)
+            n_gpu_layers=-1 if use_gpu else 0,
+            # A page image is ~1-2k prefill tokens: one 1024-token batch instead of several 256 rounds
+            n_batch=1024,
+            n_ubatch=1024,
+            flash_attn=True,       # Fused attention kernel (also required for the quantized V cache)
+            type_k=GGML_TYPE_Q8_0, # 8-bit KV cache halves attention memory traffic
+            type_v=GGML_TYPE_Q8_0,
+            # Split the CPU threads between contexts instead of oversubscribing.
+            # Prefill has its own thread count, which otherwise defaults to every core.
+            n_threads=threads_per_context,
+            n_threads_batch=threads_per_context,
+            verbose=verbose,
+            logits_all=False
+        )
         
 
     def parse_pdf_in_batches(
             self, 
-            pdf_bytes: bytes, 
+            pdf_path: str, 
             source_name: str,
             batch_size: int = 10, 
             dpi: int = 150
@@ -58,95 +133,205 @@ class VisionPDFParser:
         """
         Generator that yields extracted text in batches.
         Usage:
-            for batch in parse_pdf_in_batches(pdf_bytes, batch_size=10):
+            for batch in parse_pdf_in_batches(pdf_path, batch_size=10):
                 # This block runs every time 10 pages are finished
                 chunker.process(batch)
                 embedder.process(batch)
         Args:
-            pdf_bytes: Raw PDF file content.
+            pdf_path: Path to the PDF file on local disk.
             batch_size: Number of pages to process before yielding.
-            dpi: Image quality (150 is optimal for Qwen2-VL).
+            dpi: Maximum image quality (lowered so pages stay within MAX_IMAGE_SIDE pixels).
         Yields:
             List[Dict]: A list of results for the current batch of pages.
         """
         # Get total page count first (Fast, no conversion)
         try:
-            info = pdfinfo_from_bytes(pdf_bytes)
+            info = pdfinfo_from_path(pdf_path)
             total_pages = info["Pages"]
             logger.info(f"Starting PDF Stream: {total_pages} pages total.")
         except Exception as e:
             logger.error(f"Failed to read PDF info: {e}")
             raise ValueError("Invalid PDF file")
+
+        # Render straight at the size the model gets (fewer pixels for poppler and the VLM)
+        dpi = self._fit_dpi(info, dpi)
         
         # Main Processing Loop (The Stream)
         "This takes in batches of 10 pages from the pdf"
-        for start_page in range(1, total_pages + 1, batch_size):
-            # loop goes like 1-11 pages then 11-21 and so on 
-            # The overlap is created for not losing context at 10th and 11th page 
-            end_page = min(start_page + batch_size , total_pages)
+        # Prime the pipeline: the first batch has nothing to overlap with
+        next_images = None
+        if total_pages > 0:
+            next_images = self._raster_pool.submit(self._rasterize, pdf_path, 1, batch_size, total_pages, dpi)
 
-            logger.info(f"Extracting Batch: Pages {start_page}-{end_page}...")
-            batch_results = []
+        try:
+            for start_page in range(1, total_pages + 1, batch_size):
+                # loop goes like 1-11 pages then 11-21 and so on 
+                # The overlap is created for not losing context at 10th and 11th page 
+                end_page = min(start_page + batch_size , total_pages)
+                images_future = next_images
+                next_images = None
 
-            try:
-                # Convert only this small batch into images 
-                # Memory Check: 10 pages @ 150 DPI JPEG ~= 20-50MB RAM. Very Safe.
-                images = convert_from_bytes(
-                    pdf_bytes,
-                    first_page=start_page,
-                    last_page=end_page,
-                    dpi=dpi,  # dpi is the image quality 
-                    fmt='jpeg' # JPEG saves ~70% RAM compared to PNG
-                )
+                # Prefetch: poppler renders the next batch on the helper thread
+                # while this batch is being inferred.
+                next_start = start_page + batch_size
+                if next_start <= total_pages:
+                    next_images = self._raster_pool.submit(
+                        self._rasterize, pdf_path, next_start, batch_size, total_pages, dpi
+                    )
+
+                logger.info(f"Extracting Batch: Pages {start_page}-{end_page}...")
+                batch_results = []
+
+                try:
+                    # Wait for this batch's JPEG files (normally already rendered)
+                    page_dir, image_paths = images_future.result()
+
+                    # Batch Cleanup: leaving the block deletes the page images from disk
+                    with page_dir:
+                        # Run Inference on all images of the batch at once
+                        # Each page takes 5-10 seconds; with N contexts, N pages run side by side.
+                        # map() keeps the page order, so results line up with start_page + i.
+                        texts = self._inference_pool.map(self._run_inference, image_paths)
 
-                # Run Inference on each image
-                for i, image in enumerate(images):
-                    current_page_num = start_page + i
-                    
-                    # Run the AI to convert to image 
-                    # This line freezes the code while your GPU works. 
-                    # it waist 5-10 seconds for the AI to return markdown text
-                    text = self._run_inference(image)
-                    
-                    # stores the markdown text from the ai and then this image is useless 
-                    batch_results.append({
-                        "page_num": current_page_num,
-                        "text": text,
-                        "metadata": {
-                            "source": source_name,
-                            "total_pages": total_pages,
-                            "processed_at_dpi": dpi
-                        }
-                    })
-                    
-                    # Micro-Cleanup: Free image RAM immediately after use
-                    del image
-
-                # Batch Cleanup: Free the list reference
-                del images
-                gc.collect() # Force Python to release RAM back to OS
-
-                # EYield the result to the main worker
-                # The code PAUSES here until the main worker asks for the next batch
-                yield batch_results
-
-            except Exception as e:
-                logger.error(f"Error in batch {start_page}-{end_page}: {e}")
-                # Yield error metadata so the job doesn't fail silently
-                yield [{"page_num": start_page, "error": str(e)}]
+                        for i, text in enumerate(texts):
+                            # stores the markdown text from the ai
+                            batch_results.append({
+                                "page_num": start_page + i,
+                                "text": text,
+                                "metadata": {
+                                    "source": source_name,
+                                    "total_pages": total_pages,
+                                    "processed_at_dpi": dpi
+                                }
+                            })
+
+                    # EYield the result to the main worker
+                    # The code PAUSES here until the main worker asks for the next batch
+                    yield batch_results
+
+                except Exception as e:
+                    logger.error(f"Error in batch {start_page}-{end_page}: {e}")
+                    # Yield error metadata so the job doesn't fail silently
+                    yield [{"page_num": start_page, "error": str(e)}]
+        finally:
+            # Closed early: drop the prefetched batch that will never be inferred
+            if next_images is not None and not next_images.cancel():
+                try:
+                    unused_dir, _ = next_images.result()
+                    unused_dir.cleanup()
+                except Exception:
+                    pass
 
         logger.info("PDF Stream Complete.")
 
 
-    def _run_inference(self, image: Image.Image) -> str:
+    def _rasterize(
+            self,
+            pdf_path: str,
+            start_page: int,
+            batch_size: int,
+            total_pages: int,
+            dpi: int
+        ) -> Tuple[tempfile.TemporaryDirectory, List[str]]:
+        """
+        Convert only this small batch into JPEG files in a fresh temp directory.
+        poppler encodes the JPEGs itself, so no decoded page image is ever held in RAM
+        and the bytes can be sent to the model as they are.
+        Returns the directory (caller cleans it up) and the page paths in page order.
+        """
+        page_dir = tempfile.TemporaryDirectory(prefix="docstream-pages-")
+        try:
+            image_paths = convert_from_path(
+                pdf_path,
+                first_page=start_page,
+                last_page=min(start_page + batch_size, total_pages),
+                dpi=dpi,  # dpi is the image quality 
+                fmt='jpeg', # JPEG saves ~70% disk/RAM compared to PNG
+                jpegopt={"quality": JPEG_QUALITY},
+                output_folder=page_dir.name,
+                paths_only=True
+            )
+        except Exception:
+            page_dir.cleanup()
+            raise
+        return page_dir, image_paths
+
+
+    @staticmethod
+    def _fit_dpi(info: Dict, dpi: int) -> int:
+        """
+        Lowers the DPI so a page of the PDF's size renders with its longer side at
+        MAX_IMAGE_SIDE pixels at most (A4 @ 150 DPI is 1754px, so it becomes ~109 DPI).
+        Pages of other sizes are still downscaled later if they come out too big.
+        """
+        try:
+            # pdfinfo reports e.g. "595.276 x 841.89 pts (A4)"
+            width, height = (float(v) for v in info["Page size"].split(" pts")[0].split(" x "))
+        except (KeyError, ValueError):
+            return dpi
+        return max(1, min(dpi, int(MAX_IMAGE_SIDE * 72 / max(width, height))))
+
+
+    @staticmethod
+    def _encode_page(page_bytes: memoryview) -> str:
+        """
+        Base64 of the page JPEG. Pages within MAX_IMAGE_SIDE go out byte-for-byte;
+        bigger ones are downscaled and re-encoded first.
+        """
+        try:
+            # BytesIO copies its input, so only the header prefix goes through it
+            with Image.open(io.BytesIO(page_bytes[:JPEG_HEADER_BYTES])) as header:
+                size = header.size
+        except Exception:
+            size = None # Header longer than the prefix: decide on the full image below
+
+        if size is None or max(size) > MAX_IMAGE_SIDE:
+            with Image.open(io.BytesIO(page_bytes)) as image:
+                if max(image.size) > MAX_IMAGE_SIDE:
+                    image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.LANCZOS)
+                    buffered = io.BytesIO()
+                    image.save(buffered, format="JPEG", quality=JPEG_QUALITY)
+                    return pybase64.b64encode(buffered.getbuffer()).decode("ascii")
+
+        return pybase64.b64encode(page_bytes).decode("ascii")
+
+
+    @staticmethod
+    def _read_page(image_path: str, buffer: bytearray) -> memoryview:
+        """
+        Reads the page file into a pooled buffer (grown if the page is bigger).
+        Returns a view of just the bytes that were read.
+        """
+        size = os.path.getsize(image_path)
+        if size > len(buffer):
+            buffer.extend(bytes(size - len(buffer)))
+
+        with open(image_path, "rb", buffering=0) as f, memoryview(buffer) as view:
+            n = f.readinto(view[:size])
+        return memoryview(buffer)[:n]
+
+
+    def _run_inference(self, image_path: str) -> str:
         """
-        Helper function: Converts image to base64 and prompts the Vision Model.
+        Helper function: Converts the page JPEG to base64 and prompts the Vision Model.
         """
         try:
-            # Convert to Base64 (Required for Llama-cpp-python)
-            buffered = io.BytesIO()
-            image.save(buffered, format="JPEG", quality=95)
-            img_b64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
+            # Read the page through the buffer pool
+            buffer = self._page_buffers.get()
+            try:
+                with self._read_page(image_path, buffer) as page_bytes:
+                    # Duplicate page: return the earlier result without running the model
+                    page_key = xxhash.xxh3_64_intdigest(page_bytes)
+                    with self._page_cache_lock:
+                        cached_text = self._page_cache.get(page_key)
+                    if cached_text is not None:
+                        logger.info("Duplicate page image, reusing cached extraction.")
+                        return cached_text
+
+                    # Convert to Base64 (Required for Llama-cpp-python)
+                    img_b64 = self._encode_page(page_bytes)
+            finally:
+                self._page_buffers.put(buffer)
             data_url = f"data:image/jpeg;base64,{img_b64}"
 
             # RAG-Optimized Prompt
@@ -170,15 +355,22 @@ class VisionPDFParser:
                 }
             ]
 
-            # Inference
-            response = self.llm.create_chat_completion(
-                messages=messages,
-                max_tokens=2048,  # Cap output length
-                temperature=0.1,  # Low temperature = High Factuality
-                top_p=0.9
-            )
+            # Inference (borrow an idle context; blocks if all are busy)
+            llm = self._contexts.get()
+            try:
+                response = llm.create_chat_completion(
+                    messages=messages,
+                    max_tokens=2048,  # Cap output length
+                    temperature=0.1,  # Low temperature = High Factuality
+                    top_p=0.9
+                )
+            finally:
+                self._contexts.put(llm)
             
-            return response["choices"][0]["message"]["content"].strip()
+            text = response["choices"][0]["message"]["content"].strip()
+            with self._page_cache_lock:
+                self._page_cache[page_key] = text
+            return text
             
         except Exception as e:
             logger.error(f"Inference failed on image: {e}")
@@ -192,8 +384,11 @@ class VisionPDFParser:
         Can be used while creating docker image
         """
         try:
-            del self.llm
-            del self.chat_handler
+            self._raster_pool.shutdown(wait=True)
+            self._inference_pool.shutdown(wait=True)
+            while not self._contexts.empty():
+                llm = self._contexts.get_nowait()
+                del llm
             gc.collect()
             logger.info("Model resources released.")
         except AttributeError:
@@ -0,0 +1,118 @@
+import logging
+from pathlib import Path
+from typing import List
+import numpy as np
+import onnxruntime
+from langchain_core.embeddings import Embeddings
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from transformers import AutoTokenizer
+
+logger = logging.getLogger(__name__)
+
+QUANTIZED_FILE_NAME = "model_quantized.onnx"
+
+
+class QuantizedEmbeddings(Embeddings):
+    """
+    Sentence-transformers model exported to ONNX and quantized to int8, run on ONNX Runtime (CPU).
+    Design: Embedding dominates chunking time. int8 weights halve memory traffic and use the
+    VNNI int8 dot-product instructions, typically 2-4x faster than FP32 PyTorch for MiniLM.
+    Output matches the HuggingFaceEmbeddings setup: mean pooling + L2 normalization.
+    The export + quantization runs once; later starts load the saved int8 model.
+    """
+
+    def __init__(
+            self,
+            model_name: str,
+            cache_dir: str,
+            batch_size: int = 64,
+            max_length: int = 256,
+            num_threads: int = 0
+        ):
+        """
+        Args:
+            model_name: HuggingFace model id (bare names resolve to sentence-transformers/<name>).
+            cache_dir: Where the quantized model is stored between restarts.
+            batch_size: Sentences per ONNX Runtime call.
+            max_length: Token limit per sentence (256 for all-MiniLM-L6-v2).
+            num_threads: Intra-op threads for ONNX Runtime (0 = ONNX Runtime default).
+        """
+        model_id = model_name if "/" in model_name else f"sentence-transformers/{model_name}"
+        model_dir = Path(cache_dir) / model_id.replace("/", "--")
+
+        if not (model_dir / QUANTIZED_FILE_NAME).exists():
+            self._export_and_quantize(model_id, model_dir)
+
+        self.batch_size = batch_size
+        self.max_length = max_length
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = num_threads
+        session_options.inter_op_num_threads = 1
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir,
+            file_name=QUANTIZED_FILE_NAME,
+            provider="CPUExecutionProvider",
+            session_options=session_options
+        )
+        logger.info(f"Loaded int8 ONNX embedding model from {model_dir}")
+
+
+    @staticmethod
+    def _export_and_quantize(model_id: str, model_dir: Path):
+        """
+        One-time ONNX export + dynamic int8 quantization of the MatMul weights.
+        """
+        logger.info(f"Exporting {model_id} to ONNX and quantizing to int8 (one-time)...")
+        model = ORTModelForFeatureExtraction.from_pretrained(
+            model_id,
+            export=True,
+            provider="CPUExecutionProvider"
+        )
+        quantization_config = AutoQuantizationConfig.avx512_vnni(
+            is_static=False,
+            per_channel=True,
+            operators_to_quantize=["MatMul"]
+        )
+        quantizer = ORTQuantizer.from_pretrained(model)
+        quantizer.quantize(save_dir=model_dir, quantization_config=quantization_config)
+        AutoTokenizer.from_pretrained(model_id).save_pretrained(model_dir)
+
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+
+        # Sort by length so each batch pads to similar lengths (less wasted compute)
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = np.empty((len(texts), self.model.config.hidden_size), dtype=np.float32)
+
+        for start in range(0, len(texts), self.batch_size):
+            batch_ids = order[start:start + self.batch_size]
+            vectors[batch_ids] = self._embed_batch([texts[i] for i in batch_ids])
+
+        return vectors.tolist()
+
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed_batch([text])[0].tolist()
+
+
+    def _embed_batch(self, texts: List[str]) -> np.ndarray:
+        """
+        Tokenize -> ONNX forward -> mean pooling over real tokens -> L2 normalize.
+        """
+        inputs = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=self.max_length,
+            return_tensors="np"
+        )
+        token_embeddings = self.model(**inputs).last_hidden_state
+
+        mask = inputs["attention_mask"][..., None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.linalg.norm(pooled, axis=1, keepdims=True)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The worker modules import each other by bare name (they run from src/)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
@@ -0,0 +1,119 @@
+import random
+
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding, FakeEmbeddings
+from langchain_experimental.text_splitter import SemanticChunker
+from langchain_text_splitters import MarkdownHeaderTextSplitter
+
+from chunking import BatchedSemanticChunker, DocumentChunker
+
+# The splitter DocumentChunker.split_headers replaced
+REFERENCE_SPLITTER = MarkdownHeaderTextSplitter(
+    headers_to_split_on=[
+        ("#", "Header 1"),
+        ("##", "Header 2"),
+        ("###", "Header 3"),
+    ],
+    strip_headers=False
+)
+
+PAGES = {
+    "fence_with_info_string": (
+        "# Intro\ntext\n```python\n# comment inside code\nx=1\n```\n## After code\nmore text"
+    ),
+    "tilde_fence_around_backticks": (
+        "# Intro\n~~~\n```\n# not a header\n~~~\n## After\nbody"
+    ),
+    "inline_backticks_are_not_a_fence": (
+        "# Intro\nuse ```x``` inline\n## Next\nbody"
+    ),
+    "nested_header_only_sections": (
+        "# Title\n## Section\n### Part\nbody\n## Other\nmore"
+    ),
+    "header_only_before_shallower_header": (
+        "# A\n## B\n# C\nbody"
+    ),
+    "text_before_first_header": (
+        "preamble line\n\n# Title\nbody\n\nsecond paragraph\n#### not split\n#hashtag"
+    ),
+    "trailing_header_only": (
+        "# Title\nbody\n## Empty"
+    ),
+    "repeated_header_path": (
+        "# Notes\nfirst\n# Notes\nsecond\n## Sub\nthird\n## Sub\nfourth"
+    ),
+    "tab_after_hashes_is_not_a_header": (
+        "# Intro\nbody\n#\tTitle\n##\tOther\nmore"
+    ),
+}
+
+
+@pytest.fixture(scope="module")
+def chunker():
+    return DocumentChunker(embedding_model=FakeEmbeddings(size=8))
+
+
+def sections(docs):
+    """
+    Compares line content and metadata. The reference joins paragraphs with "  \\n" and
+    drops non-printable characters (tabs) from each line, split_headers keeps the text as is.
+    """
+    return [
+        (
+            ["".join(filter(str.isprintable, line.strip())) for line in doc.page_content.split("\n") if line.strip()],
+            doc.metadata
+        )
+        for doc in docs
+    ]
+
+
+@pytest.mark.parametrize("text", PAGES.values(), ids=PAGES.keys())
+def test_split_headers_matches_markdown_header_splitter(chunker, text):
+    [result] = chunker.split_headers([text])
+    assert sections(result) == sections(REFERENCE_SPLITTER.split_text(text))
+
+
+def test_split_headers_keeps_pages_apart(chunker):
+    # A code block left open on one page must not swallow the next page's headers
+    texts = list(PAGES.values()) + ["```\nunclosed", "# Fresh\nbody"]
+    results = chunker.split_headers(texts)
+
+    assert len(results) == len(texts)
+    for text, result in zip(texts, results):
+        assert sections(result) == sections(REFERENCE_SPLITTER.split_text(text))
+
+
+WORDS = "alpha beta gamma delta epsilon zeta eta theta iota kappa lambda sigma".split()
+
+
+def generated_documents(count: int):
+    """
+    Documents of 1-30 random sentences, so short (skipped) and long pages are both covered.
+    """
+    rng = random.Random(42)
+    documents = []
+    for n in range(count):
+        sentences = [
+            " ".join(rng.choices(WORDS, k=rng.randint(3, 12))).capitalize() + rng.choice(".?!")
+            for _ in range(rng.randint(1, 30))
+        ]
+        documents.append(Document(page_content=" ".join(sentences), metadata={"page_num": n}))
+    return documents
+
+
+@pytest.mark.parametrize("threshold_type", ["percentile", "standard_deviation", "gradient"])
+def test_batched_semantic_chunker_matches_semantic_chunker(threshold_type):
+    embeddings = DeterministicFakeEmbedding(size=32)
+    documents = generated_documents(200)
+
+    batched = BatchedSemanticChunker(embeddings=embeddings, breakpoint_threshold_type=threshold_type)
+    reference = SemanticChunker(embeddings=embeddings, breakpoint_threshold_type=threshold_type)
+
+    results = batched.split_document_batch(documents)
+
+    assert len(results) == len(documents)
+    for document, chunks in zip(documents, results):
+        expected = reference.split_documents([document])
+        assert [(c.page_content, c.metadata) for c in chunks] == \
+            [(c.page_content, c.metadata) for c in expected]
@@ -0,0 +1,71 @@
+from typing import List
+
+from langchain_core.embeddings import DeterministicFakeEmbedding, Embeddings
+
+from embedding_cache import CachedEmbeddings
+
+
+class CountingEmbeddings(Embeddings):
+    """
+    Records every text that reaches the model.
+    """
+
+    def __init__(self):
+        self.model = DeterministicFakeEmbedding(size=8)
+        self.calls: List[List[str]] = []
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls.append(list(texts))
+        return self.model.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.model.embed_query(text)
+
+
+def assert_close(actual, expected):
+    assert len(actual) == len(expected)
+    for a, e in zip(actual, expected):
+        assert all(abs(x - y) < 1e-6 for x, y in zip(a, e))
+
+
+def test_duplicates_in_one_call_are_embedded_once():
+    model = CountingEmbeddings()
+    cached = CachedEmbeddings(model)
+    texts = ["header", "body", "header", "footer", "body"]
+
+    vectors = cached.embed_documents(texts)
+
+    assert model.calls == [["header", "body", "footer"]]
+    assert_close(vectors, model.model.embed_documents(texts))
+
+
+def test_memory_tier_serves_repeats_and_evicts_oldest():
+    model = CountingEmbeddings()
+    cached = CachedEmbeddings(model, max_memory_items=2)
+
+    cached.embed_documents(["a", "b"])
+    cached.embed_documents(["a", "b"])
+    assert model.calls == [["a", "b"]]
+
+    # "a" was used last, so "b" is the one evicted
+    cached.embed_documents(["a", "c"])
+    cached.embed_documents(["a", "b"])
+    assert model.calls == [["a", "b"], ["c"], ["b"]]
+
+
+def test_second_instance_is_served_from_disk(tmp_path):
+    texts = ["one sentence", "another sentence"]
+
+    first_model = CountingEmbeddings()
+    expected = CachedEmbeddings(first_model, cache_dir=str(tmp_path), namespace="m").embed_documents(texts)
+    assert first_model.calls == [texts]
+
+    second_model = CountingEmbeddings()
+    second = CachedEmbeddings(second_model, cache_dir=str(tmp_path), namespace="m")
+    assert_close(second.embed_documents(texts), expected)
+    assert second_model.calls == []
+
+    # Another namespace (model) never reads these vectors
+    third_model = CountingEmbeddings()
+    CachedEmbeddings(third_model, cache_dir=str(tmp_path), namespace="other").embed_documents(texts)
+    assert third_model.calls == [texts]